@@ -21,6 +21,7 @@ from bpy.props import IntProperty, FloatProperty, FloatVectorProperty
 # for split logic.
 import random
 import math
+import time
 
 # TODO add seed for noise, same of Random!
 from mathutils import Vector, Matrix 
@@ -44,23 +45,163 @@ import tree_general_functions
 importlib.reload(tree_general_functions)
 import tree_light_functions
 importlib.reload(tree_light_functions)
+import tree_collision_functions
+importlib.reload(tree_collision_functions)
 import tree_armature_functions
 importlib.reload(tree_armature_functions)
 from tree_armature_functions import *
 import tree_mesh_functions
 importlib.reload(tree_mesh_functions)
-from tree_mesh_functions import create_section_mesh
+import tree_analysis_functions
+importlib.reload(tree_analysis_functions)
+from tree_analysis_functions import create_tree_rings, find_thin_regions, find_intersections
+import tree_generation_functions
+importlib.reload(tree_generation_functions)
+from tree_generation_functions import TreeGeneration, create_tree_sections
 
 
 def update_tree(self, context):
+    # Regenerating without the operator: a slider drag calls this many times, and
+    # each operator call would push an undo step holding a copy of the tree mesh.
+    # Blender pushes a single undo step once the change is committed.
     if context.scene.tree_parameters.auto_update:
-        bpy.ops.growtree.create_tree()
+        if context.scene.tree_parameters.progressive:
+            start_progressive_generation(context)
+        else:
+            stop_progressive_generation()
+            generation = TreeGeneration(context.scene.tree_parameters)
+            generation.run()
+            create_tree_object(context, generation=generation)
+            if generation.budget_warning is not None:
+                print(generation.budget_warning)
+
+
+def create_generation_meshes(generation):
+    # Returns the tree mesh, followed by its lower levels of detail if any. While the
+    # generation is running, the mesh shows the partial tree: the geometry is built
+    # along by the generation, and only copied into the meshes here.
+    meshes = []
+    for lod, builder in enumerate(generation.builders):
+        meshes.append(builder.to_mesh("Tree" if lod == 0 else f"Tree LOD{lod}"))
+    return meshes
+
+
+def set_object_mesh(context, obj_name, mesh):
+    # Reusing the object and removing its previous mesh, so that stale copies of
+    # the tree don't pile up in memory and in the undo steps.
+    if obj_name in bpy.data.objects:
+        obj = bpy.data.objects[obj_name]
+        old_mesh = obj.data
+        obj.data = mesh
+        if old_mesh is not None and old_mesh.users == 0:
+            bpy.data.meshes.remove(old_mesh)
+    else:
+        obj = bpy.data.objects.new(obj_name, mesh)
+
+    # Linking it to the scene if needed. Timers have no active collection.
+    if obj.name not in context.scene.objects:
+        collection = context.collection if context.collection is not None else context.scene.collection
+        collection.objects.link(obj)
+    return obj
+
+
+def create_tree_object(context, obj_name="Created Tree", generation=None):
+    if generation is None:
+        generation = TreeGeneration(context.scene.tree_parameters)
+        generation.run()
+    meshes = create_generation_meshes(generation)
+    if generation.finished:
+        generation.free()
+    obj = set_object_mesh(context, obj_name, meshes[0])
+    for lod, mesh in enumerate(meshes[1:], start=1):
+        set_object_mesh(context, f"{obj_name} LOD{lod}", mesh)
+
+    # Removing the levels of detail that aren't generated anymore.
+    lod = len(meshes)
+    while f"{obj_name} LOD{lod}" in bpy.data.objects:
+        old_obj = bpy.data.objects[f"{obj_name} LOD{lod}"]
+        old_mesh = old_obj.data
+        bpy.data.objects.remove(old_obj)
+        if old_mesh is not None and old_mesh.users == 0:
+            bpy.data.meshes.remove(old_mesh)
+        lod += 1
+    return obj
+
+
+# Progressive generation: the generation runs in time slices from a timer, showing
+# the partial tree after each of them.
+progressive_generation = None
+
+# Time of the last mesh copy, and the generation time since then, in seconds.
+progressive_copy_time = 0
+progressive_run_time = 0
+
+def stop_progressive_generation():
+    # Cancelling the running generation, so that it doesn't overwrite a tree created
+    # in the meantime.
+    global progressive_generation
+    if bpy.app.timers.is_registered(run_progressive_generation):
+        bpy.app.timers.unregister(run_progressive_generation)
+    if progressive_generation is not None:
+        progressive_generation.free()
+        progressive_generation = None
+
+
+def start_progressive_generation(context):
+    # Restarting from scratch, as the parameters have changed.
+    global progressive_generation, progressive_copy_time, progressive_run_time
+    if progressive_generation is not None:
+        progressive_generation.free()
+    progressive_generation = TreeGeneration(context.scene.tree_parameters)
+    progressive_copy_time = 0
+    progressive_run_time = 0
+    if not bpy.app.timers.is_registered(run_progressive_generation):
+        bpy.app.timers.register(run_progressive_generation)
+
+
+def run_progressive_generation():
+    global progressive_generation, progressive_copy_time, progressive_run_time
+    generation = progressive_generation
+    if generation is None:
+        return None
+
+    # Copying the partial tree into the object takes longer as the tree grows, so it
+    # is counted in the frame budget, and skipped while the generation has run for
+    # less time than the last copy took: the copies never take more than about half
+    # of the time.
+    frame_budget = generation.tree_parameters.frame_budget / 1000
+    copy_mesh = progressive_run_time + frame_budget >= 2 * progressive_copy_time
+    run_budget = max(frame_budget - progressive_copy_time, 0) if copy_mesh else frame_budget
+    start_time = time.perf_counter()
+    finished = generation.run(run_budget)
+    progressive_run_time += time.perf_counter() - start_time
+    if finished or copy_mesh:
+        start_time = time.perf_counter()
+        create_tree_object(bpy.context, generation=generation)
+        progressive_copy_time = time.perf_counter() - start_time
+        progressive_run_time = 0
+    if finished:
+        if generation.budget_warning is not None:
+            print(generation.budget_warning)
+        progressive_generation = None
+
+        # The undo step of the property change holds the tree as it was when the
+        # change was committed, which is only the start of the generation: pushing
+        # one for the finished tree.
+        if bpy.ops.ed.undo_push.poll():
+            bpy.ops.ed.undo_push(message="Grow Tree")
+        return None
+
+    # Running again as soon as the viewport has been redrawn.
+    return 0.001
 
 
 class GROWTREE_PG_tree_parameters(bpy.types.PropertyGroup):
 
     # General Properties
     auto_update: bpy.props.BoolProperty(name="Auto Update", default=True)
+    progressive: bpy.props.BoolProperty(name="Progressive Update", default=False)
+    frame_budget: bpy.props.IntProperty(name="Frame Budget (ms)", default=30, min=5, max=500)
     seed: bpy.props.IntProperty(name="Seed", default=0, update=update_tree)
     iterations: bpy.props.IntProperty(name="Iterations", default=256, min=0, max=1024, update=update_tree)
     radius: bpy.props.FloatProperty(name="Trunk Base Radius", default=0.5, min=0.1, max=10, update=update_tree)
@@ -90,6 +231,7 @@ class GROWTREE_PG_tree_parameters(bpy.types.PropertyGroup):
     light_searching_2D: bpy.props.FloatVectorProperty(name="Light Searching", default=(0.5, 0.5), min=0, max=2, size=2, update=update_tree)
     light_searching_fringes: bpy.props.FloatProperty(name="Light Searching Fringes", default=3, min=0, max=10, update=update_tree)
     ground_avoiding: bpy.props.FloatProperty(name="Ground Avoiding", default=0.5, min=0, max=5, update=update_tree)
+    branch_avoiding: bpy.props.FloatProperty(name="Branch Avoiding", default=0, min=0, max=5, update=update_tree)
     trunk_gravity: bpy.props.FloatProperty(name="Trunk Gravity", default=0.2, min=0, max=1, update=update_tree)
     noise_2D: bpy.props.FloatVectorProperty(name="Growth Noise", default=(0.1, 0.5), min=0, max=10, size=2, update=update_tree)
     noise_scale_2D: bpy.props.FloatVectorProperty(name="Volumetric Noise Scale", default=(1, 0.2), min=0.01, max=5, size=2, update=update_tree)
@@ -98,12 +240,24 @@ class GROWTREE_PG_tree_parameters(bpy.types.PropertyGroup):
     # Meshing
     generate_mesh: bpy.props.BoolProperty(name="Generate Mesh", default=False, update=update_tree)
     branch_resolution: bpy.props.IntProperty(name="Branch Resolution", default=24, min=3, max=64, update=update_tree)
+    connected_joints: bpy.props.BoolProperty(name="Connected Joints", default=False, update=update_tree)
+    adaptive_meshing: bpy.props.BoolProperty(name="Adaptive Meshing", default=False, update=update_tree)
+    adaptive_tolerance: bpy.props.FloatProperty(name="Adaptive Tolerance", default=0.05, min=0.001, max=1, update=update_tree)
+    mesh_budget: bpy.props.FloatProperty(name="Mesh Budget (MB)", default=1024, min=1, max=65536, update=update_tree)
+    budget_action: bpy.props.EnumProperty(name="Over Budget", default='ARMATURE', update=update_tree, items=[
+        ('ARMATURE', "Armature Only", "Skip the mesh and show the tree armature"),
+        ('ADAPTIVE', "Adaptive Meshing", "Switch to adaptive meshing, or to the armature if still over budget"),
+    ])
+    lod_levels: bpy.props.IntProperty(name="LOD Levels", default=1, min=1, max=4, update=update_tree)
     minimum_thickness: bpy.props.FloatProperty(name="Min Thickness", default=0.15, min=0.01, max=0.5, update=update_tree)
     chunkyness: bpy.props.FloatProperty(name="Chunkyness", default=0.5, min=0.1, max=2, update=update_tree)
     surface_noise_planar_2D: bpy.props.FloatVectorProperty(name="Surface Planar Noise Scale", default=(2, 2), min=0.01, max=5, size=2, update=update_tree)
     surface_noise_vertical_2D: bpy.props.FloatVectorProperty(name="Surface Vertical Noise Scale", default=(0.05, 0.05), min=0.01, max=5, size=2, update=update_tree)
     surface_noise_intensity_2D: bpy.props.FloatVectorProperty(name="Surface Noise Intensity", default=(0.1, 0.1), min=0.01, max=5, size=2, update=update_tree)
 
+    # Printability
+    min_wall_thickness: bpy.props.FloatProperty(name="Min Wall Thickness", default=0.15, min=0.01, max=5)
+
 
 class GROWTREE_OT_save_config(bpy.types.Operator):
     bl_idname = "growtree.save_config"
@@ -173,108 +327,52 @@ class GROWTREE_OT_create_tree(bpy.types.Operator):
 
     tree_parameters: bpy.props.PointerProperty(type=GROWTREE_PG_tree_parameters)
 
+    def execute(self, context):
+        stop_progressive_generation()
+        generation = TreeGeneration(context.scene.tree_parameters)
+        generation.run()
+        create_tree_object(context, generation=generation)
+        if generation.budget_warning is not None:
+            self.report({'WARNING'}, generation.budget_warning)
+        return {'FINISHED'}
+
+
+class GROWTREE_OT_check_printability(bpy.types.Operator):
+    bl_idname = "growtree.check_printability"
+    bl_label = "Check Printability"
+    bl_options = {'REGISTER', 'UNDO'}
+
     def execute(self, context):
         tree_parameters = context.scene.tree_parameters
 
-        mesh = self.create_tree_mesh(tree_parameters)
-        obj_name = "Created Tree"
-        
-        # Unlink and remove the old object if it exists
+        # The tree is regrown from the same seed, so that each ring is known to
+        # belong to its section.
+        sections = create_tree_sections(tree_parameters)
+        tree_frames, tree_rings = create_tree_rings(sections, tree_parameters)
+        thin_regions = find_thin_regions(tree_frames, tree_rings, tree_parameters.min_wall_thickness)
+        intersections = find_intersections(sections, tree_rings)
+
+        # Marking the issues with loose vertices, to be inspected in the viewport.
+        obj_name = "Tree Printability Issues"
         if obj_name in bpy.data.objects:
             old_obj = bpy.data.objects[obj_name]
-            if old_obj.name in context.collection.objects:
-                context.collection.objects.unlink(old_obj)
+            old_mesh = old_obj.data
             bpy.data.objects.remove(old_obj)
-
-        # Create a new object and link it to the scene
-        obj = bpy.data.objects.new(obj_name, mesh)
-        context.collection.objects.link(obj)
-
+            if old_mesh is not None and old_mesh.users == 0:
+                bpy.data.meshes.remove(old_mesh)
+        issue_points = [region[3] for region in thin_regions] + [intersection[2] for intersection in intersections]
+        if issue_points:
+            mesh = bpy.data.meshes.new(obj_name)
+            mesh.from_pydata(issue_points, [], [])
+            obj = bpy.data.objects.new(obj_name, mesh)
+            context.collection.objects.link(obj)
+
+        thin_sections = len({region[0] for region in thin_regions})
+        report_type = {'WARNING'} if issue_points else {'INFO'}
+        self.report(report_type, f"{len(thin_regions)} rings thinner than {tree_parameters.min_wall_thickness:.3f} " + \
+            f"in {thin_sections} sections, {len(intersections)} intersecting section pairs")
         return {'FINISHED'}
 
-    def create_tree_mesh(self, tree_parameters):
-
-        mesh = bpy.data.meshes.new("Tree")
-        bm = bmesh.new()
-
-        # Setting the random seed
-        random.seed(tree_parameters.seed)
-
-        # Creating the tree body
-        trunk_section = Section( \
-            points=[Vector((0, 0, 0)),Vector((0, 0, 0.1))], \
-            weight=tree_parameters.iterations, \
-            depth=1,\
-            distance=1)
-        sections = [trunk_section]
-
-        # Growing iterations
-        for iteration_number in range(tree_parameters.iterations):
-            grow_step(sections, tree_parameters, iteration_number)
-            new_sections = check_splits(sections, tree_parameters, iteration_number)
-
-            # Extending only if a pair of new section exists.
-            sections.extend(new_sections)                
-
-        # Applying Noise 
-        sections = apply_noise(sections, tree_parameters)
-
-        # Creating the roots: very similar to the branches, but not quite.
-        root_sections = create_root_sections(tree_parameters)
-        for iteration_number in range(tree_parameters.iterations):
-            grow_root(root_sections, tree_parameters, iteration_number)
-        root_sections = apply_roots_sinking(root_sections, tree_parameters)
-
-        # Extending sections with the root sections:
-        sections.extend(root_sections)
-
-        # Creating main mesh
-        mesh = bpy.data.meshes.new("Tree")
-        bm = bmesh.new()
-        
-        # If the "Generate Mesh" button is selected.
-        if tree_parameters.generate_mesh:
-            section_matrix = Matrix.Identity(4)
-            
-            # Generate mesh with cylinders
-            for section in sections:
-                section_mesh = create_section_mesh(section, tree_parameters)
-                temp_bm = bmesh.new()
-                temp_bm.from_mesh(section_mesh)
-                temp_bm.transform(section_matrix)
-                bmesh.ops.transform(temp_bm, matrix=section_matrix, verts=temp_bm.verts)
-                bmesh.ops.contextual_create(temp_bm, geom=temp_bm.edges)
-                vertex_map = {}
-
-                for v in temp_bm.verts:
-                    new_vert = bm.verts.new(v.co)
-                    vertex_map[v.index] = new_vert
-                bm.verts.ensure_lookup_table()
-
-                for e in temp_bm.edges:
-                    bm.edges.new([vertex_map[e.verts[0].index], vertex_map[e.verts[1].index]])
-                bm.edges.ensure_lookup_table()
-
-                for f in temp_bm.faces:
-                    bm.faces.new([vertex_map[v.index] for v in f.verts])  # Add this line
-                bm.faces.ensure_lookup_table()  # Add this line
-
-                temp_bm.free()
-
-        else:
-            # Generate mesh with segments
-            for section in sections:
-                v0 = bm.verts.new(section.points[0])
-                for i in range(len(section.points) - 1):
-                    v1 = bm.verts.new(section.points[i + 1])
-                    bm.edges.new([v0, v1])
-                    v0 = v1
-
-        bm.to_mesh(mesh)  # Keep this line
-        bm.free()  # Keep this line
-
-        return mesh
-
 
 # Blender GUI
 class GROWTREE_PT_create_tree_panel(bpy.types.Panel):
@@ -300,7 +398,7 @@ class GROWTREE_PT_create_tree_panel(bpy.types.Panel):
 
         box = layout.box()
         box.label(text="General Properties")
-        props = ["auto_update", "seed", "iterations", "radius", "trunk_branches_division_2D"]
+        props = ["auto_update", "progressive", "frame_budget", "seed", "iterations", "radius", "trunk_branches_division_2D"]
         for prop_name in props:
             self.draw_prop(box, tree_parameters, prop_name)
 
@@ -322,19 +420,24 @@ class GROWTREE_PT_create_tree_panel(bpy.types.Panel):
         box = layout.box()
         box.label(text="Deformation")
         props = ["light_source_3D", "light_searching_2D", "light_searching_fringes", 
-                 "ground_avoiding", "trunk_gravity", "noise_2D", 
+                 "ground_avoiding", "branch_avoiding", "trunk_gravity", "noise_2D", 
                  "noise_scale_2D", "noise_intensity_2D"]
         for prop_name in props:
             self.draw_prop(box, tree_parameters, prop_name)
 
         box = layout.box()
         box.label(text="Meshing")
-        props = ["generate_mesh", "branch_resolution", "minimum_thickness", 
+        props = ["generate_mesh", "branch_resolution", "connected_joints", "adaptive_meshing", "adaptive_tolerance", "mesh_budget", "budget_action", "lod_levels", "minimum_thickness", 
                  "chunkyness", "surface_noise_planar_2D", "surface_noise_vertical_2D", 
                  "surface_noise_intensity_2D"]
         for prop_name in props:
             self.draw_prop(box, tree_parameters, prop_name)
 
+        box = layout.box()
+        box.label(text="Printability")
+        self.draw_prop(box, tree_parameters, "min_wall_thickness")
+        box.operator(GROWTREE_OT_check_printability.bl_idname)
+
         layout.operator(GROWTREE_OT_create_tree.bl_idname)
 
         # Adding the saving and loading options.
@@ -351,15 +454,18 @@ def register():
     bpy.utils.register_class(GROWTREE_OT_save_config)
     bpy.utils.register_class(GROWTREE_OT_load_config)
     bpy.utils.register_class(GROWTREE_OT_create_tree)
+    bpy.utils.register_class(GROWTREE_OT_check_printability)
     bpy.utils.register_class(GROWTREE_PT_create_tree_panel)
     bpy.types.Scene.tree_parameters = bpy.props.PointerProperty(type=GROWTREE_PG_tree_parameters)
     bpy.types.VIEW3D_MT_mesh_add.append(menu_func)
 
 def unregister():
+    stop_progressive_generation()
     bpy.utils.unregister_class(GROWTREE_PG_tree_parameters)
     bpy.utils.unregister_class(GROWTREE_OT_save_config)
     bpy.utils.unregister_class(GROWTREE_OT_load_config)
     bpy.utils.unregister_class(GROWTREE_OT_create_tree)
+    bpy.utils.unregister_class(GROWTREE_OT_check_printability)
     bpy.utils.unregister_class(GROWTREE_PT_create_tree_panel)
     del bpy.types.Scene.tree_parameters
     bpy.types.VIEW3D_MT_mesh_add.remove(menu_func)
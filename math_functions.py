@@ -1,5 +1,6 @@
 import random
 import math
+from functools import lru_cache
 from mathutils import Vector
 
 
@@ -21,6 +22,12 @@ def cosine_sigmoid(x, min, max):
 def softplus(x, factor):
     return math.log(1 + math.exp(x * factor)) / factor
 
+@lru_cache(maxsize=None)
+def get_unit_circle(resolution):
+    # Cached (cos, sin) pairs for a circle of the given resolution.
+    return tuple((math.cos(2 * math.pi * i / resolution), math.sin(2 * math.pi * i / resolution)) \
+        for i in range(resolution))
+
 def uniform_random_direction():
     theta = random.uniform(0, 2 * math.pi)
     phi = math.acos(random.uniform(-1, 1))
@@ -1,6 +1,23 @@
 import math
+from array import array
+from functools import lru_cache
 from mathutils import Vector, noise
 
+# The surface noise is baked into a texture indexed by (angle, offset along the
+# branch). It's periodic in angle since it's sampled on a circle, and it tiles
+# along the branch by cross-fading the end of one period into the start of the
+# next. Only the last part of the period is faded, the rest is the noise itself,
+# and the fade is scaled to keep the contrast, which a plain blend of two noises
+# flattens. Past a period the pattern repeats.
+RADIUS_NOISE_SAMPLES_PER_UNIT = 8
+RADIUS_NOISE_VERTICAL_PERIOD = 32
+RADIUS_NOISE_FADE_FRACTION = 0.25
+
+# A tree uses at most two textures, one per planar scale extreme. Keeping a couple
+# more avoids baking them again when toggling between values, while a slider drag
+# doesn't leave a texture behind for each intermediate value.
+RADIUS_NOISE_TEXTURE_CACHE_SIZE = 4
+
 def displace_point_with_noise(point, intensity, scale):
     # Convert the point's position to a coordinate in noise space
     noise_coord = point * scale
@@ -21,4 +38,66 @@ def displace_point_with_noise(point, intensity, scale):
 def get_radius_noise(angle_rad, planar_scale, offset):
     # Translate 
     noise_coord = Vector((math.sin(angle_rad), math.cos(angle_rad), offset));
-    return noise.noise(noise_coord * planar_scale)
\ No newline at end of file
+    return noise.noise(noise_coord * planar_scale)
+
+class RadiusNoiseTexture:
+    def __init__(self, planar_scale, resolution):
+        # Columns are a multiple of the ring resolution, so that all the vertices of a
+        # ring share the same interpolation weights.
+        samples_around = 2 * math.pi * planar_scale * RADIUS_NOISE_SAMPLES_PER_UNIT
+        self.resolution = resolution
+        self.columns_per_vertex = max(1, math.ceil(samples_around / resolution))
+        self.columns = resolution * self.columns_per_vertex
+        self.rows = RADIUS_NOISE_VERTICAL_PERIOD * RADIUS_NOISE_SAMPLES_PER_UNIT
+        self.period = RADIUS_NOISE_VERTICAL_PERIOD / planar_scale
+
+        self.values = []
+        for row in range(self.rows):
+            offset = row / self.rows * self.period
+            fade = max(0, (row / self.rows - 1) / RADIUS_NOISE_FADE_FRACTION + 1)
+            contrast = math.sqrt((1 - fade) ** 2 + fade ** 2)
+            row_values = array('d')
+            for column in range(self.columns):
+                angle = 2 * math.pi * column / self.columns
+                current_value = get_radius_noise(angle, planar_scale, offset)
+                next_value = get_radius_noise(angle, planar_scale, offset - self.period)
+                value = (current_value * (1 - fade) + next_value * fade) / contrast
+                row_values.append(min(1, max(-1, value)))
+            self.values.append(row_values)
+
+    def sample_ring(self, initial_angle, offset, resolution=None):
+        # Bilinear sampling of a whole ring, starting from initial_angle. Rings of a
+        # lower resolution than the texture's are sampled between its vertices.
+        if resolution is None:
+            resolution = self.resolution
+        column_position = initial_angle / (2 * math.pi) * self.columns
+        first_column = math.floor(column_position)
+        column_factor = column_position - first_column
+
+        row_position = (offset % self.period) / self.period * self.rows
+        first_row = math.floor(row_position)
+        row_factor = row_position - first_row
+        bottom_row = self.values[first_row % self.rows]
+        top_row = self.values[(first_row + 1) % self.rows]
+
+        samples = []
+        column_step = self.columns / resolution
+        for i in range(resolution):
+            if resolution == self.resolution:
+                column = (first_column + i * self.columns_per_vertex) % self.columns
+                factor = column_factor
+            else:
+                vertex_column = column_position + i * column_step
+                column = math.floor(vertex_column)
+                factor = vertex_column - column
+                column = column % self.columns
+            next_column = (column + 1) % self.columns
+            left = bottom_row[column] + (top_row[column] - bottom_row[column]) * row_factor
+            right = bottom_row[next_column] + (top_row[next_column] - bottom_row[next_column]) * row_factor
+            samples.append(left + (right - left) * factor)
+        return samples
+
+@lru_cache(maxsize=RADIUS_NOISE_TEXTURE_CACHE_SIZE)
+def get_radius_noise_texture(planar_scale, resolution):
+    # Textures are cached, so that interactive updates don't bake them again.
+    return RadiusNoiseTexture(planar_scale, resolution)
\ No newline at end of file
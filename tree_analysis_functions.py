@@ -0,0 +1,110 @@
+import math
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+
+from tree_mesh_functions import get_mesh_frames, create_circle_verts, get_tube_faces
+
+# Rays are started slightly inside the surface, so that they don't hit the faces
+# around the vertex they are cast from.
+RAY_START_OFFSET = 1e-4
+
+
+def get_related_sections(sections):
+    # Sections touching by construction: parent and children overlap at the split,
+    # and so do siblings. Roots have no parent but all start on the trunk axis, so
+    # they are related to the trunk and to each other, like siblings of the trunk.
+    related = [{counter} for counter in range(len(sections))]
+    children = {}
+    for counter, section in enumerate(sections):
+        if section.parent_id is None:
+            if section.is_root:
+                related[counter].add(0)
+                related[0].add(counter)
+                children.setdefault(None, []).append(counter)
+            continue
+        related[counter].add(section.parent_id)
+        related[section.parent_id].add(counter)
+        children.setdefault(section.parent_id, []).append(counter)
+    for siblings in children.values():
+        for counter in siblings:
+            related[counter].update(siblings)
+    return related
+
+def create_tree_rings(sections, tree_parameters):
+    tree_frames = []
+    tree_rings = []
+    for section in sections:
+        if len(section.points) < 2:
+            tree_frames.append([])
+            tree_rings.append([])
+            continue
+        frames, resolution = get_mesh_frames(section, tree_parameters)
+        tree_frames.append(frames)
+        tree_rings.append([create_circle_verts(*frame, tree_parameters, resolution) for frame in frames])
+    return tree_frames, tree_rings
+
+def find_thin_regions(tree_frames, tree_rings, min_thickness):
+    # Returns (section_id, ring_id, thickness, position) for each ring thinner than
+    # min_thickness. The thickness is measured by casting rays across the section.
+    thin_regions = []
+    for section_id, (frames, rings) in enumerate(zip(tree_frames, tree_rings)):
+        if len(rings) < 2:
+            continue
+        section_tree = None
+        for ring_id, (frame, ring) in enumerate(zip(frames, rings)):
+            center = frame[0]
+
+            # Any ray through the center crosses at least twice the inner radius of the
+            # ring polygon, so most rings don't need any ray at all. The polygon edges
+            # pass closer to the center than the vertices, more so at low resolution.
+            closest_distance = min((Vector(vert) - center).length for vert in ring)
+            if 2 * closest_distance * math.cos(math.pi / len(ring)) >= min_thickness:
+                continue
+
+            if section_tree is None:
+                section_verts = [vert for section_ring in rings for vert in section_ring]
+                section_tree = BVHTree.FromPolygons(section_verts, get_tube_faces(len(rings), len(rings[0]), closed=False))
+
+            # Opposite vertices measure the same chord, half of the ring is enough.
+            ring_thickness = math.inf
+            for vert in ring[:(len(ring) + 1) // 2]:
+                vert = Vector(vert)
+                inwards = (center - vert).normalized()
+                _, _, _, hit_distance = section_tree.ray_cast(vert + inwards * RAY_START_OFFSET, inwards)
+                if hit_distance is not None:
+                    ring_thickness = min(ring_thickness, hit_distance + RAY_START_OFFSET)
+
+            if ring_thickness < min_thickness:
+                thin_regions.append((section_id, ring_id, ring_thickness, center.copy()))
+    return thin_regions
+
+def find_intersections(sections, tree_rings):
+    # Returns (section_id, other_section_id, position) for each pair of unrelated
+    # sections whose surfaces intersect, using a single BVH over the whole tree.
+    verts = []
+    faces = []
+    face_sections = []
+    for section_id, rings in enumerate(tree_rings):
+        if len(rings) < 2:
+            continue
+        section_faces = get_tube_faces(len(rings), len(rings[0]), first_index=len(verts))
+        verts.extend(vert for ring in rings for vert in ring)
+        faces.extend(section_faces)
+        face_sections.extend([section_id] * len(section_faces))
+
+    if not faces:
+        return []
+
+    tree = BVHTree.FromPolygons(verts, faces)
+    related = get_related_sections(sections)
+    intersections = {}
+    for face_id, other_face_id in tree.overlap(tree):
+        section_id = face_sections[face_id]
+        other_section_id = face_sections[other_face_id]
+        if other_section_id in related[section_id]:
+            continue
+        key = (min(section_id, other_section_id), max(section_id, other_section_id))
+        if key not in intersections:
+            face_center = sum((Vector(verts[i]) for i in faces[face_id]), Vector()) / len(faces[face_id])
+            intersections[key] = face_center
+    return [(key[0], key[1], position) for key, position in intersections.items()]
@@ -7,6 +7,7 @@ from tree_general_functions import *
 from tree_light_functions import *
 from math_functions import uniform_random_direction
 from tree_section import Section
+from tree_collision_functions import get_avoidance_direction
 
 def get_growth_direction(previous_point1, previous_point2, section, iteration_number, tree_parameters):
     direction = (previous_point2 - previous_point1).normalized()
@@ -41,8 +42,16 @@ def get_root_growth_direction(previous_point1, previous_point2, section, iterati
     return final_direction.normalized()
 
 
-def grow_step(sections, tree_parameters, iteration_number):
-    for section in sections:
+def avoid_branches(point, direction, segment_length, radius, section, section_id, tree_parameters, segment_hash):
+    # Direction steered away from the other branches, looking at where the next points
+    # would end up. Without a segment hash the direction is unchanged.
+    if segment_hash is None:
+        return direction
+    return get_avoidance_direction(point, direction, segment_length, radius, section, section_id, segment_hash, \
+        tree_parameters.branch_avoiding, tree_parameters.minimum_thickness)
+
+def grow_step(sections, tree_parameters, iteration_number, segment_hash=None):
+    for counter, section in enumerate(sections):
         if section.open_end:  
             
             # Checking for thickness
@@ -56,15 +65,19 @@ def grow_step(sections, tree_parameters, iteration_number):
             segment_length = combine_lerp_2D(tree_parameters.segment_length_2D, thickness_param)
             last_point = section.points[-1]
             quasi_last_point = section.points[-2]
-            new_point = last_point + get_growth_direction(\
+            direction = get_growth_direction(\
                 quasi_last_point, \
                 last_point, \
                 section, \
                 iteration_number, \
-                tree_parameters) *\
-                segment_length
+                tree_parameters)
+            direction = avoid_branches(last_point, direction, segment_length, radius, \
+                section, counter, tree_parameters, segment_hash)
+            new_point = last_point + direction * segment_length
             section.points.append(new_point)
             section.distance = section.distance + 1
+            if segment_hash is not None:
+                segment_hash.add_segment(last_point, new_point, radius, counter, section.parent_id)
 
 def grow_root(root_sections, tree_parameters, iteration_number):
     for section in root_sections:
@@ -90,7 +103,7 @@ def grow_root(root_sections, tree_parameters, iteration_number):
             section.points.append(new_point)
             section.distance = section.distance + 1
 
-def check_splits(sections, tree_parameters, iteration_number):
+def check_splits(sections, tree_parameters, iteration_number, segment_hash=None):
     
     new_sections = []
     for counter, section in enumerate(sections):
@@ -163,14 +176,17 @@ def check_splits(sections, tree_parameters, iteration_number):
             direction2.rotate(Quaternion(initial_direction.normalized(), split_rotation))
 
             # Now calculating the effects on the new direction, then adding it to the new sections.
-            new_section1.points.extend([new_section1.points[-1] + \
-                get_branches_direction(direction1, new_section1, tree_parameters, iteration_number) *\
-                    segment_length])
-            new_section2.points.extend([new_section2.points[-1] + \
-                get_branches_direction(direction2, new_section2, tree_parameters, iteration_number) *\
-                    segment_length])
-                    
-            new_sections.extend([new_section1, new_section2])
+            for new_section, direction in [(new_section1, direction1), (new_section2, direction2)]:
+                new_section_id = len(sections) + len(new_sections)
+                split_point = new_section.points[-1]
+                direction = get_branches_direction(direction, new_section, tree_parameters, iteration_number)
+                new_radius = get_radius_from_weight(tree_parameters, new_section)
+                direction = avoid_branches(split_point, direction, segment_length, new_radius, \
+                    new_section, new_section_id, tree_parameters, segment_hash)
+                new_section.points.extend([split_point + direction * segment_length])
+                if segment_hash is not None:
+                    segment_hash.add_segment(split_point, new_section.points[-1], new_radius, new_section_id, counter)
+                new_sections.append(new_section)
 
     return new_sections
 
@@ -204,30 +220,26 @@ def avoid_ground(value, parameter):
     # Interpolate between the original value and the sigmoid
     return combine_lerp(softplus(value, 6), value, parameter)  
 
-def apply_noise(sections, tree_parameters): 
-    new_sections = []
-    for section in sections:
-
-        # Applying the noise factor now. 
-        thickness = get_thickness_parameter(tree_parameters, section)
-        noise_scale=combine_lerp_2D(tree_parameters.noise_scale_2D, thickness)
-        noise_intensity=combine_lerp_2D(tree_parameters.noise_intensity_2D, thickness)
+def apply_section_noise(section, sections, tree_parameters):
+
+    # Applying the noise factor now. 
+    thickness = get_thickness_parameter(tree_parameters, section)
+    noise_scale=combine_lerp_2D(tree_parameters.noise_scale_2D, thickness)
+    noise_intensity=combine_lerp_2D(tree_parameters.noise_intensity_2D, thickness)
+    new_points = []
+    for point in section.points: 
+        new_points.append(displace_point_with_noise(point, noise_intensity, noise_scale))
+        #temp_section.points.append(point)
+    section.points = new_points
+    
+    # Translating the section to the position of the parent last point
+    if section.parent is not None:
+        parent_last_point = sections[section.parent_id].points[-1]
+        translation_vector = section.points[0] - parent_last_point
         new_points = []
-        for point in section.points: 
-            new_points.append(displace_point_with_noise(point, noise_intensity, noise_scale))
-            #temp_section.points.append(point)
+        for point in section.points:
+            new_points.append(point - translation_vector)
         section.points = new_points
-        
-        # Translating the section to the position of the parent last point
-        if section.parent is not None:
-            parent_last_point = sections[section.parent_id].points[-1]
-            translation_vector = section.points[0] - parent_last_point
-            new_points = []
-            for point in section.points:
-                new_points.append(point - translation_vector)
-            section.points = new_points
-
-    return sections
 
 def create_root_sections(tree_parameters):
     root_sections = []
@@ -0,0 +1,113 @@
+import math
+from mathutils import Vector
+
+# Number of segment lengths looked ahead when steering, so that branches start turning
+# before they reach each other instead of one step too late.
+AVOIDANCE_LOOKAHEAD_STEPS = 4
+
+
+class SegmentHash:
+    # Hierarchical grid of the tree segments, updated while the tree grows. Level k
+    # has cells of cell_size * 2 ** k. A segment belongs to the first level whose
+    # cells are as large as its reach (radius plus clearance), and is stored in every
+    # cell its bounding box, grown by the reach, touches. It is also stored in the
+    # coarser levels, so that each level holds all the segments up to its size.
+    # A query then looks at the few cells around the point in the first level as
+    # large as the queried distance, and at the coarser levels for the segments
+    # belonging there only: the cells visited don't grow with the radii.
+    def __init__(self, cell_size, clearance, max_radius):
+        self.cell_size = cell_size
+        self.clearance = clearance
+        self.segments = []
+
+        # Each level keeps the cells of all the segments up to its size, and the cells
+        # of its own segments.
+        self.levels = [({}, {})]
+        while self.cell_size * 2 ** (len(self.levels) - 1) < max_radius + clearance:
+            self.levels.append(({}, {}))
+
+    def get_level(self, size):
+        # First level whose cells are as large as size, or the coarsest one.
+        level = 0
+        while level < len(self.levels) - 1 and self.cell_size * 2 ** level < size:
+            level += 1
+        return level
+
+    def get_cells(self, lower, upper, level):
+        size = self.cell_size * 2 ** level
+        for x in range(math.floor(lower.x / size), math.floor(upper.x / size) + 1):
+            for y in range(math.floor(lower.y / size), math.floor(upper.y / size) + 1):
+                for z in range(math.floor(lower.z / size), math.floor(upper.z / size) + 1):
+                    yield (x, y, z)
+
+    def add_segment(self, start, end, radius, section_id, parent_id):
+        segment_index = len(self.segments)
+        self.segments.append((start.copy(), end.copy(), radius, section_id, parent_id))
+
+        reach = radius + self.clearance
+        lower = Vector((min(start.x, end.x), min(start.y, end.y), min(start.z, end.z))) - Vector((reach, reach, reach))
+        upper = Vector((max(start.x, end.x), max(start.y, end.y), max(start.z, end.z))) + Vector((reach, reach, reach))
+        home_level = self.get_level(reach)
+        for level in range(home_level, len(self.levels)):
+            level_cells, own_cells = self.levels[level]
+            for cell in self.get_cells(lower, upper, level):
+                level_cells.setdefault(cell, []).append(segment_index)
+                if level == home_level:
+                    own_cells.setdefault(cell, []).append(segment_index)
+
+    def query(self, point, distance):
+        # Indices of the segments that may be closer to point than distance plus their
+        # own radius and the clearance.
+        lower = point - Vector((distance, distance, distance))
+        upper = point + Vector((distance, distance, distance))
+        query_level = self.get_level(distance)
+        segment_indices = set()
+        for level in range(query_level, len(self.levels)):
+            cells = self.levels[level][0 if level == query_level else 1]
+            if not cells:
+                continue
+            for cell in self.get_cells(lower, upper, level):
+                segment_indices.update(cells.get(cell, ()))
+        return segment_indices
+
+
+def closest_point_on_segment(point, start, end):
+    segment = end - start
+    length_squared = segment.length_squared
+    if length_squared == 0:
+        return start
+    factor = min(1, max(0, (point - start).dot(segment) / length_squared))
+    return start + segment * factor
+
+def get_avoidance_direction(point, direction, step_length, radius, section, section_id, segment_hash, \
+        avoidance, clearance):
+    # Steering direction away from the segments closer than the sum of the radii plus
+    # clearance, sampled along the next steps of the branch from point, the nearest
+    # steps weighing the most. The section itself is ignored, and so are its parent,
+    # grandparent, siblings and uncles where they pass by the section start, since
+    # they touch it there by construction.
+    related_ids = ()
+    if section.parent is not None:
+        related_ids = (section.parent_id, section.parent.parent_id)
+    joint = section.points[0]
+
+    repulsion = Vector((0, 0, 0))
+    for step in range(1, AVOIDANCE_LOOKAHEAD_STEPS + 1):
+        sample = point + direction * step_length * step
+        for segment_index in segment_hash.query(sample, radius):
+            start, end, other_radius, other_section_id, other_parent_id = segment_hash.segments[segment_index]
+            if other_section_id == section_id:
+                continue
+            offset = sample - closest_point_on_segment(sample, start, end)
+            distance = offset.length
+            reach = radius + other_radius + clearance
+            if distance == 0 or distance >= reach:
+                continue
+            if (other_section_id in related_ids or other_parent_id in related_ids) and \
+                    (joint - closest_point_on_segment(joint, start, end)).length < reach:
+                continue
+            repulsion = repulsion + offset / distance * (1 - distance / reach) / step
+
+    if repulsion.length_squared == 0:
+        return direction
+    return (direction + repulsion * avoidance).normalized()
@@ -0,0 +1,222 @@
+import random
+import time
+from mathutils import Vector
+
+from tree_section import Section
+from tree_armature_functions import *
+from tree_collision_functions import SegmentHash
+from tree_mesh_functions import create_section_rings, estimate_mesh_size, \
+    MeshBuilder, ArmatureBuilder, add_section_tube, add_connected_geometry
+
+
+class TreeParameters:
+    # Plain copy of the tree parameters. A progressive generation runs over several
+    # frames, and reading the scene properties along would mix the values from before
+    # and after a change; the arrays are copied into tuples for the same reason.
+    def __init__(self, tree_parameters):
+        if hasattr(tree_parameters, "bl_rna"):
+            names = [prop.identifier for prop in tree_parameters.bl_rna.properties if prop.identifier != "rna_type"]
+        else:
+            names = [name for name in {**vars(type(tree_parameters)), **vars(tree_parameters)} if not name.startswith("_")]
+        for name in names:
+            value = getattr(tree_parameters, name)
+            if not isinstance(value, (bool, int, float, str)):
+                value = tuple(value)
+            setattr(self, name, value)
+
+
+class TreeGeneration:
+    # A tree generation that can be paused and resumed. The work is split in units
+    # (growth iterations, noise and meshing of a section) by generate_tree, and run
+    # runs as many of them as the time budget allows. With build_meshes, the geometry
+    # to display is built along in the same units: builders holds the mesh built so
+    # far, followed by its lower levels of detail once finished.
+    def __init__(self, tree_parameters, generate_mesh=None, build_meshes=True):
+        tree_parameters = TreeParameters(tree_parameters)
+        self.tree_parameters = tree_parameters
+        self.generate_mesh = tree_parameters.generate_mesh if generate_mesh is None else generate_mesh
+        self.build_meshes = build_meshes
+        self.sections = []
+        self.tree_rings = []
+        self.builders = []
+        self.stage = "growth"
+        self.mesh_estimate = None
+        self.mesh_frames = None
+        self.budget_warning = None
+        self.finished = False
+        self.steps = generate_tree(self)
+
+        # The random state is kept with the generation, so that other code using
+        # random between two runs doesn't change the tree.
+        random.seed(tree_parameters.seed)
+        self.random_state = random.getstate()
+
+    def run(self, time_budget=None):
+        # Runs work units until the time budget in seconds is over, or until the
+        # generation is finished if there's no budget. Returns True when finished.
+        if self.finished:
+            return True
+        random.setstate(self.random_state)
+        start_time = time.perf_counter()
+        for _ in self.steps:
+            if time_budget is not None and time.perf_counter() - start_time > time_budget:
+                break
+        else:
+            self.finished = True
+        self.random_state = random.getstate()
+        return self.finished
+
+    def set_builders(self, builders):
+        # Freeing the builders that aren't shown anymore.
+        for builder in self.builders:
+            if builder not in builders:
+                builder.free()
+        self.builders = builders
+
+    def free(self):
+        self.set_builders([])
+
+
+def generate_tree(generation):
+    tree_parameters = generation.tree_parameters
+
+    # Creating the tree body
+    trunk_section = Section( \
+        points=[Vector((0, 0, 0)),Vector((0, 0, 0.1))], \
+        weight=tree_parameters.iterations, \
+        depth=1,\
+        distance=1)
+    sections = [trunk_section]
+    generation.sections = sections
+
+    # The armature is shown until the mesh of the first section is ready.
+    armature = None
+    if generation.build_meshes:
+        armature = ArmatureBuilder()
+        armature.update(sections)
+        generation.set_builders([armature])
+
+    # Keeping track of the existing segments only if branches avoid each other. The
+    # finest cells are sized from the segments rather than the trunk, so that thin
+    # branches only look at the few cells around them.
+    segment_hash = None
+    if tree_parameters.branch_avoiding > 0:
+        segment_hash = SegmentHash(max(tree_parameters.segment_length_2D) + tree_parameters.minimum_thickness, \
+            tree_parameters.minimum_thickness, tree_parameters.radius)
+        segment_hash.add_segment(trunk_section.points[0], trunk_section.points[1], tree_parameters.radius, 0, None)
+
+    # Growing iterations
+    for iteration_number in range(tree_parameters.iterations):
+        grow_step(sections, tree_parameters, iteration_number, segment_hash)
+        new_sections = check_splits(sections, tree_parameters, iteration_number, segment_hash)
+
+        # Extending only if a pair of new section exists.
+        sections.extend(new_sections)
+        if armature is not None:
+            armature.update(sections)
+        yield
+
+    # Applying Noise
+    generation.stage = "noise"
+    for section_id, section in enumerate(sections):
+        apply_section_noise(section, sections, tree_parameters)
+        if armature is not None:
+            armature.move_section(section_id, section)
+        yield
+
+    # Creating the roots: very similar to the branches, but not quite.
+    generation.stage = "roots"
+    root_sections = create_root_sections(tree_parameters)
+    for iteration_number in range(tree_parameters.iterations):
+        grow_root(root_sections, tree_parameters, iteration_number)
+        yield
+    root_sections = apply_roots_sinking(root_sections, tree_parameters)
+
+    # Extending sections with the root sections:
+    sections.extend(root_sections)
+    if armature is not None:
+        armature.update(sections)
+
+    # Computing the rings of each section, if the mesh is needed and fits the budget.
+    # The tubes are shown as soon as the sections are meshed.
+    if generation.generate_mesh:
+        generation.stage = "estimate"
+        adaptive_meshing = yield from check_mesh_budget(generation, sections)
+        if adaptive_meshing is not None:
+            generation.stage = "mesh"
+            tubes = None
+            if generation.build_meshes:
+                tubes = MeshBuilder()
+                generation.set_builders([tubes])
+            for section_id, section in enumerate(sections):
+                rings = []
+                if len(section.points) >= 2:
+                    mesh_frames = None
+                    if generation.mesh_frames is not None:
+                        mesh_frames = generation.mesh_frames[section_id]
+                    rings = create_section_rings(section, tree_parameters, adaptive_meshing, mesh_frames)
+                generation.tree_rings.append(rings)
+                if tubes is not None:
+                    add_section_tube(tubes, rings)
+                yield
+
+            if tubes is not None:
+                yield from build_final_meshes(generation, tubes)
+
+    generation.stage = "finished"
+
+def build_final_meshes(generation, tubes):
+    # Building the connected surface and the levels of detail from the rings, a
+    # section or a joint per work unit. The tubes stay on display until all of them
+    # are done, and are the first level themselves if the joints aren't connected.
+    tree_parameters = generation.tree_parameters
+    builders = []
+    for lod in range(tree_parameters.lod_levels):
+        if lod == 0 and not tree_parameters.connected_joints:
+            builders.append(tubes)
+            continue
+        builder = MeshBuilder()
+        builders.append(builder)
+        if tree_parameters.connected_joints:
+            yield from add_connected_geometry(builder, generation.sections, generation.tree_rings, lod)
+        else:
+            for rings in generation.tree_rings:
+                add_section_tube(builder, rings, lod)
+                yield
+    generation.set_builders(builders)
+
+def check_mesh_budget(generation, sections):
+    # Estimating the mesh before building it, in work units as well. Returns whether
+    # to use adaptive meshing, or None if the mesh doesn't fit the budget at all. The
+    # budget warning is set whenever the mesh doesn't fit as configured. The frames
+    # decimated by an adaptive estimate are kept in the generation for the meshing.
+    tree_parameters = generation.tree_parameters
+    adaptive_meshing = tree_parameters.adaptive_meshing
+    budget = tree_parameters.mesh_budget * 1024 * 1024
+    mesh_frames = [] if adaptive_meshing else None
+    generation.mesh_estimate = yield from estimate_mesh_size(sections, tree_parameters, adaptive_meshing, mesh_frames)
+    vertex_count, _, memory = generation.mesh_estimate
+    if memory <= budget:
+        generation.mesh_frames = mesh_frames
+        return adaptive_meshing
+
+    warning = f"Estimated mesh of {vertex_count} vertices ({memory / 1024 / 1024:.0f} MB) " + \
+        f"is over the budget of {tree_parameters.mesh_budget:g} MB"
+    if tree_parameters.budget_action == 'ADAPTIVE' and not adaptive_meshing:
+        # Giving up on the adaptive mesh as soon as it's over the budget as well.
+        mesh_frames = []
+        mesh_estimate = yield from estimate_mesh_size(sections, tree_parameters, True, mesh_frames, budget)
+        vertex_count, _, memory = mesh_estimate
+        if memory <= budget:
+            generation.mesh_estimate = mesh_estimate
+            generation.mesh_frames = mesh_frames
+            generation.budget_warning = warning + f": switched to adaptive meshing ({vertex_count} vertices)."
+            return True
+
+    generation.budget_warning = warning + ": showing the armature only."
+    return None
+
+def create_tree_sections(tree_parameters):
+    generation = TreeGeneration(tree_parameters, generate_mesh=False, build_meshes=False)
+    generation.run()
+    return generation.sections
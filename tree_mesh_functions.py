@@ -2,14 +2,13 @@ import bpy
 import bmesh
 
 from mathutils import Vector
+from mathutils.bvhtree import BVHTree
 from noise_displacements import *
 from tree_general_functions import *
 from tree_light_functions import *
 from math_functions import *
 
-def create_circle_verts(position, direction, radius, point_distance, thickness_parameter, tree_parameters):
-    circle_verts = []
-
+def get_ring_basis(direction):
     # Compute an orthogonal basis for the circle's plane
     up = Vector((1, 0, 0))
     if abs(direction.dot(up)) > 0.99:
@@ -19,25 +18,54 @@ def create_circle_verts(position, direction, radius, point_distance, thickness_p
 
     # Determine the initial angle based on the direction
     initial_angle = math.atan2(direction.y, direction.x)
-                
+
+    # Rotating the basis by the initial angle once, so that the cached unit circle
+    # can be used for all the vertices. The rotated side points to the first vertex.
+    cos_initial, sin_initial = math.cos(initial_angle), math.sin(initial_angle)
+    rotated_side = side * cos_initial + up * sin_initial
+    rotated_up = up * cos_initial - side * sin_initial
+    return rotated_side, rotated_up, initial_angle
+
+def create_circle_verts(position, direction, radius, point_distance, thickness_parameter, tree_parameters, resolution=None):
+    circle_verts = []
+    rotated_side, rotated_up, initial_angle = get_ring_basis(direction)
+
     thickness = thickness_parameter
-    surface_noise_planar = combine_lerp_2D(tree_parameters.surface_noise_planar_2D, thickness)
+    texture_resolution = tree_parameters.branch_resolution
+    if resolution is None:
+        resolution = texture_resolution
+    surface_noise_planar_2D = tree_parameters.surface_noise_planar_2D
     surface_noise_vertical = combine_lerp_2D(tree_parameters.surface_noise_vertical_2D, thickness)
     surface_noise_intensity = combine_lerp_2D(tree_parameters.surface_noise_intensity_2D, thickness)
-    section_step_length = combine_lerp_2D(tree_parameters.segment_length_2D, thickness)
 
-    for i in range(tree_parameters.branch_resolution):
-        angle = (2 * math.pi / tree_parameters.branch_resolution) * i + initial_angle
-        radius_noise = get_radius_noise(angle, surface_noise_planar, \
-                                        surface_noise_vertical * point_distance)
-        
-        vertex = position + combine_lerp(radius, radius*radius_noise, 1-surface_noise_intensity) *\
-                (math.cos(angle) * side + math.sin(angle) * up)
-        circle_verts.append(vertex)
+    # Sampling the baked noise for the whole ring. If the planar scale changes with
+    # the thickness, the textures of the two extremes are blended: this is not the
+    # noise at the intermediate scale, and the surface pattern differs from it.
+    offset = surface_noise_vertical * point_distance
+    radius_noise = get_radius_noise_texture(surface_noise_planar_2D[0], texture_resolution).sample_ring( \
+        initial_angle, offset, resolution)
+    if surface_noise_planar_2D[0] != surface_noise_planar_2D[1]:
+        top_radius_noise = get_radius_noise_texture(surface_noise_planar_2D[1], texture_resolution).sample_ring( \
+            initial_angle, offset, resolution)
+        radius_noise = [combine_lerp(bottom, top, thickness) for bottom, top in zip(radius_noise, top_radius_noise)]
+
+    px, py, pz = position
+    sx, sy, sz = rotated_side
+    ux, uy, uz = rotated_up
+    base_radius = radius * (1 - surface_noise_intensity)
+    noise_radius = radius * surface_noise_intensity
+
+    for (cos_angle, sin_angle), noise_value in zip(get_unit_circle(resolution), radius_noise):
+        vertex_radius = base_radius + noise_radius * noise_value
+        x = cos_angle * vertex_radius
+        y = sin_angle * vertex_radius
+        circle_verts.append((px + x * sx + y * ux, py + x * sy + y * uy, pz + x * sz + y * uz))
 
     return circle_verts
 
-def create_section_mesh(section, tree_parameters):
+def get_section_frames(section, tree_parameters):
+    # Each frame describes one ring of the section:
+    # (position, direction, radius, point_distance, thickness)
     thickness = get_thickness_parameter_base(tree_parameters, section)
     if section.parent is None:
         if not section.is_root:
@@ -53,11 +81,7 @@ def create_section_mesh(section, tree_parameters):
         parent_distance = section.parent.distance
         parent_thickness = get_thickness_parameter_base(tree_parameters, section.parent)
 
-    mesh = bpy.data.meshes.new("Branch")
-    bm = bmesh.new()
-
-    previous_circle_verts = None
-    bottom_bm_edges = None
+    frames = []
     reference_point = None
     
     for i in range(len(section.points)):
@@ -95,41 +119,459 @@ def create_section_mesh(section, tree_parameters):
         lerped_thickness = combine_lerp(thickness, parent_thickness, lerp_factor)
         lerped_thickness = math.sqrt(lerped_thickness)
         point_distance = parent_distance + i
-        current_circle_verts = create_circle_verts(
-            lerped_position, direction, lerped_radius, point_distance, lerped_thickness, tree_parameters
-        )
-        
-        # Creating this loop's vertices and edges:
-        bm_verts = []
-        for j in range(tree_parameters.branch_resolution):
-            bm_verts.append(bm.verts.new(current_circle_verts[j]))
-
-        bm_edges = []
-        for j in range(tree_parameters.branch_resolution):
-            v0 = bm_verts[j]
-            v1 = bm_verts[(j + 1) % tree_parameters.branch_resolution]
-            if (v0, v1) not in bm.edges and (v1, v0) not in bm.edges:
-                bm_edges.append(bm.edges.new([v0, v1]))
-
-        # If none, filling the bottom.
-        if previous_circle_verts is None: 
-            bmesh.ops.contextual_create(bm, geom=bm_verts)
-
-        # else, calling bridge loop    
-        if previous_circle_verts is not None:
-            edge_loops = bottom_bm_edges + bm_edges
-            bmesh.ops.bridge_loops(bm, edges=edge_loops)
-            
-        # If last element, closing.
-        if i == len(section.points) - 1:
-            bmesh.ops.contextual_create(bm, geom=bm_verts)
+        frames.append((lerped_position, direction, lerped_radius, point_distance, lerped_thickness))
+
+    return frames
+
+def get_adaptive_resolution(radius, tolerance, max_resolution):
+    # Fewest vertices keeping the polygon within tolerance from the circle.
+    if tolerance >= radius:
+        return 3
+    resolution = math.ceil(math.pi / math.acos(1 - tolerance / radius))
+    return min(max_resolution, max(3, resolution))
+
+def get_noise_amplitude(frame, tree_parameters):
+    # Largest displacement of the ring vertices by the surface noise. Adaptive
+    # meshing doesn't follow the noise, so it counts as error wherever the mesh is
+    # simplified.
+    _, _, radius, _, thickness = frame
+    return radius * combine_lerp_2D(tree_parameters.surface_noise_intensity_2D, thickness)
+
+# Decimation checks all the frames between the last kept one and the candidate, so
+# the spans are bounded to keep the cost linear in the frames of long sections.
+DECIMATION_MAX_SPAN = 64
+
+def decimate_frames(frames, resolution, tolerance, noise_amplitudes):
+    # Dropping the frames that can be replaced by the interpolation of their kept
+    # neighbours. The error of a dropped frame bounds the distance of each of its
+    # vertices from the faces between the kept rings: the error of the center, plus
+    # the error of the ring axes scaled by the radius, which covers radius, tilt and
+    # twist. Twisted faces aren't flat, and their triangles are off the interpolation
+    # by up to a quarter of the difference of their opposite edges. The faces don't
+    # follow the noise, neither of the dropped ring nor of the kept ones, so both add
+    # to the error.
+    half_edge_sine = math.sin(math.pi / resolution)
+    ring_axes = []
+    for _, direction, radius, _, _ in frames:
+        side, up, _ = get_ring_basis(direction)
+        ring_axes.append((side * radius, up * radius))
+
+    kept_frames = [frames[0]]
+    anchor = 0
+    for end in range(2, len(frames)):
+        start_position = frames[anchor][0]
+        axis = frames[end][0] - start_position
+        axis_length_squared = axis.length_squared
+        side_change = ring_axes[end][0] - ring_axes[anchor][0]
+        up_change = ring_axes[end][1] - ring_axes[anchor][1]
+        face_error = half_edge_sine / 2 * math.sqrt(side_change.length_squared + up_change.length_squared)
+        fits = end - anchor <= DECIMATION_MAX_SPAN and axis_length_squared > 0
+        for i in range(anchor + 1, end):
+            if not fits:
+                break
+            position = frames[i][0]
+            factor = min(1, max(0, (position - start_position).dot(axis) / axis_length_squared))
+            position_error = (position - (start_position + axis * factor)).length
+            side_error = ring_axes[i][0] - ring_axes[anchor][0].lerp(ring_axes[end][0], factor)
+            up_error = ring_axes[i][1] - ring_axes[anchor][1].lerp(ring_axes[end][1], factor)
+            ring_error = math.sqrt(side_error.length_squared + up_error.length_squared)
+            noise_error = noise_amplitudes[i] + max(noise_amplitudes[anchor], noise_amplitudes[end])
+            fits = position_error + ring_error + face_error + noise_error <= tolerance
+        if not fits:
+            anchor = end - 1
+            kept_frames.append(frames[anchor])
+    kept_frames.append(frames[-1])
+    return kept_frames
+
+def get_mesh_frames(section, tree_parameters, adaptive_meshing=None):
+    # Frames and ring resolution used to mesh the section. In adaptive meshing the
+    # resolution follows the radius, and rings are dropped along straight stretches.
+    # The faces of a simplified ring don't follow the noise of the vertices around
+    # them, so the noise counts twice: half of the tolerance left by the noise goes
+    # to the resolution, and what the resolution doesn't use to dropping rings. Rings
+    # with a noise over half the tolerance keep the full resolution.
+    if adaptive_meshing is None:
+        adaptive_meshing = tree_parameters.adaptive_meshing
+    frames = get_section_frames(section, tree_parameters)
+    resolution = tree_parameters.branch_resolution
+    if adaptive_meshing and len(frames) > 1:
+        tolerance = tree_parameters.adaptive_tolerance
+        noise_amplitudes = [get_noise_amplitude(frame, tree_parameters) for frame in frames]
+        max_resolution = resolution
+        resolution = 3
+        for frame, noise_amplitude in zip(frames, noise_amplitudes):
+            if 2 * noise_amplitude >= tolerance:
+                resolution = max_resolution
+                break
+            resolution = max(resolution, \
+                get_adaptive_resolution(frame[2], (tolerance - 2 * noise_amplitude) / 2, max_resolution))
+
+        # Noise over half the tolerance on every ring leaves no room to drop any.
+        if 2 * min(noise_amplitudes) > tolerance:
+            return frames, resolution
+
+        polygon_error = 0
+        if resolution < max_resolution:
+            polygon_error = max(frame[2] for frame in frames) * (1 - math.cos(math.pi / resolution))
+        frames = decimate_frames(frames, resolution, tolerance - polygon_error, noise_amplitudes)
+    return frames, resolution
+
+def create_section_rings(section, tree_parameters, adaptive_meshing=None, mesh_frames=None):
+    # mesh_frames are the frames and resolution from get_mesh_frames, if already known.
+    if mesh_frames is None:
+        mesh_frames = get_mesh_frames(section, tree_parameters, adaptive_meshing)
+    frames, resolution = mesh_frames
+    rings = []
+    for position, direction, radius, point_distance, thickness in frames:
+        rings.append(create_circle_verts(position, direction, radius, point_distance, thickness, \
+            tree_parameters, resolution))
+    return rings
+
+# Rough memory cost of the generated geometry: the vertex positions and the bmesh
+# of the builders, and the Blender mesh built from them.
+BYTES_PER_VERTEX = 200
+BYTES_PER_FACE = 150
+
+def estimate_mesh_size(sections, tree_parameters, adaptive_meshing=None, mesh_frames=None, memory_budget=None):
+    # Estimate of (vertices, faces, bytes) of the tree mesh, from the armature only.
+    # In adaptive meshing the frames are decimated as for the mesh itself, which
+    # takes some time: this is a generator going through a section per step, and
+    # returning the estimate. The decimated frames are appended to mesh_frames if
+    # given, one entry per section (None if not meshed), to be reused for meshing.
+    # With memory_budget, the estimate stops as soon as it is over it.
+    if adaptive_meshing is None:
+        adaptive_meshing = tree_parameters.adaptive_meshing
+
+    # Lower levels of detail have about a quarter of the geometry of the previous one.
+    lod_factor = sum(0.25 ** lod for lod in range(tree_parameters.lod_levels))
+    vertex_count = 0
+    face_count = 0
+    memory = 0
+    for section in sections:
+        ring_count = len(section.points)
+        if ring_count < 2:
+            if mesh_frames is not None:
+                mesh_frames.append(None)
+            continue
+        resolution = tree_parameters.branch_resolution
+        if adaptive_meshing:
+            frames, resolution = get_mesh_frames(section, tree_parameters, True)
+            ring_count = len(frames)
+            if mesh_frames is not None:
+                mesh_frames.append((frames, resolution))
+            yield
+        vertex_count += ring_count * resolution
+        face_count += (ring_count - 1) * resolution + 2
+        memory = (vertex_count * BYTES_PER_VERTEX + face_count * BYTES_PER_FACE) * lod_factor
+        if memory_budget is not None and memory > memory_budget:
+            break
+    return vertex_count, face_count, memory
+
+class MeshBuilder:
+    # Mesh built piece by piece in a bmesh, so that a running generation can add its
+    # geometry in small work units and show what is built so far at any time. The
+    # vertex positions are kept for the functions working on indices.
+    def __init__(self):
+        self.bm = bmesh.new()
+        self.positions = []
+        self.bm_verts = []
+
+    def add_verts(self, positions):
+        # Returns the index of the first added vertex.
+        first_index = len(self.positions)
+        for position in positions:
+            self.positions.append(tuple(position))
+            self.bm_verts.append(self.bm.verts.new(position))
+        return first_index
+
+    def add_edges(self, edges):
+        for edge in edges:
+            self.bm.edges.new([self.bm_verts[i] for i in edge])
+
+    def add_faces(self, faces):
+        for face in faces:
+            self.bm.faces.new([self.bm_verts[i] for i in face])
+
+    def to_mesh(self, name):
+        mesh = bpy.data.meshes.new(name)
+        self.bm.to_mesh(mesh)
+        mesh.update()
+        return mesh
+
+    def free(self):
+        self.bm.free()
+
+
+class ArmatureBuilder(MeshBuilder):
+    # Armature of the tree, a vertex per point and an edge per segment, following the
+    # sections as they grow.
+    def __init__(self):
+        super().__init__()
+        self.section_verts = []
+
+    def update(self, sections):
+        # Adding the points grown since the last update.
+        for section_id, section in enumerate(sections):
+            if section_id == len(self.section_verts):
+                self.section_verts.append([])
+            indices = self.section_verts[section_id]
+            for point in section.points[len(indices):]:
+                index = self.add_verts([point])
+                if indices:
+                    self.add_edges([(indices[-1], index)])
+                indices.append(index)
+
+    def move_section(self, section_id, section):
+        # Moving the vertices of a section whose points have been displaced.
+        for index, point in zip(self.section_verts[section_id], section.points):
+            self.positions[index] = tuple(point)
+            self.bm_verts[index].co = point
+
+
+def get_tube_faces(ring_count, resolution, first_index=0, closed=True):
+    # Faces of a tube made of ring_count consecutive rings of the same resolution,
+    # whose vertices start at first_index. The winding keeps the normals outwards.
+    faces = []
+    for i in range(ring_count - 1):
+        bottom = first_index + i * resolution
+        top = bottom + resolution
+        for j in range(resolution):
+            next_j = (j + 1) % resolution
+            faces.append((bottom + j, top + j, top + next_j, bottom + next_j))
+
+    # Capping both ends.
+    if closed:
+        last = first_index + (ring_count - 1) * resolution
+        faces.append(tuple(range(first_index, first_index + resolution)))
+        faces.append(tuple(reversed(range(last, last + resolution))))
+    return faces
+
+def subsample_rings(rings, lod):
+    # Rings of a lower level of detail: each level halves both the ring resolution
+    # and the amount of rings, always keeping the first and the last one.
+    step = 2 ** lod
+    resolution = len(rings[0])
+    lod_resolution = max(3, resolution // step)
+    angle_indices = [round(j * resolution / lod_resolution) for j in range(lod_resolution)]
+    ring_indices = list(range(0, len(rings), step))
+    if ring_indices[-1] != len(rings) - 1:
+        ring_indices.append(len(rings) - 1)
+    return [[rings[i][j] for j in angle_indices] for i in ring_indices]
+
+def add_section_tube(builder, rings, lod=0):
+    # Adding a section to the builder as a closed tube.
+    if len(rings) < 2:
+        return
+    if lod > 0:
+        rings = subsample_rings(rings, lod)
+    first_index = builder.add_verts(vert for ring in rings for vert in ring)
+    builder.add_faces(get_tube_faces(len(rings), len(rings[0]), first_index=first_index))
+
+def get_ring_center_radius(ring):
+    center = sum((Vector(vert) for vert in ring), Vector((0, 0, 0))) / len(ring)
+    radius = sum((Vector(vert) - center).length for vert in ring) / len(ring)
+    return center, radius
+
+# Rings of each child past the first kept one checked against the joint faces. The
+# siblings are apart from the first kept rings on, so intersections come from the
+# joint faces folding over the children where they bend right after the split.
+JOINT_CHECK_RINGS = 2
+
+def get_joint_split(parent_center, parent_direction, child_rings):
+    # Where two sibling sections come apart: the first ring of each from which they
+    # are ahead of the end of the parent, and on either side of a plane along the
+    # parent direction between them. The shorter sibling stops at its last ring while
+    # the other one goes on. Returns the ring indices, the normal of the plane,
+    # pointing to the first sibling, and its offset from the parent center, halfway
+    # between the two rings. Returns None if the siblings don't come apart.
+    for i in range(1, max(len(rings) for rings in child_rings)):
+        start_rings = [min(i, len(rings) - 1) for rings in child_rings]
+        rings = [child_rings[k][start_rings[k]] for k in range(2)]
+        split_direction = get_ring_center_radius(rings[0])[0] - get_ring_center_radius(rings[1])[0]
+        split_direction = split_direction - parent_direction * split_direction.dot(parent_direction)
+        if split_direction.length_squared == 0:
+            continue
+        split_direction = split_direction.normalized()
+        if any((Vector(vert) - parent_center).dot(parent_direction) <= 0 for ring in rings for vert in ring):
+            continue
+        first_lowest = min((Vector(vert) - parent_center).dot(split_direction) for vert in rings[0])
+        second_highest = max((Vector(vert) - parent_center).dot(split_direction) for vert in rings[1])
+        if first_lowest > second_highest:
+            return start_rings, split_direction, (first_lowest + second_highest) / 2
+    return None
+
+def get_bridge_faces(loop, ring):
+    # Faces between two closed loops of vertex indices going the same way around,
+    # possibly with a different amount of vertices. Both loops are walked together,
+    # adding quads where they are in step and triangles elsewhere.
+    loop_count, ring_count = len(loop), len(ring)
+    faces = []
+    i = j = 0
+    while i < loop_count or j < ring_count:
+        a0, a1 = loop[i % loop_count], loop[(i + 1) % loop_count]
+        b0, b1 = ring[j % ring_count], ring[(j + 1) % ring_count]
+        loop_next = (i + 1) * ring_count
+        ring_next = (j + 1) * loop_count
+        if i < loop_count and j < ring_count and loop_next == ring_next:
+            faces.append((a0, b0, b1, a1))
+            i += 1
+            j += 1
+        elif j >= ring_count or (i < loop_count and loop_next < ring_next):
+            faces.append((a0, b0, a1))
+            i += 1
+        else:
+            faces.append((a0, b0, b1))
+            j += 1
+    return faces
+
+def align_ring(verts, loop, ring):
+    # Rotating the ring so that its first vertex faces the first vertex of the loop.
+    loop_center, _ = get_ring_center_radius([verts[i] for i in loop])
+    ring_center, _ = get_ring_center_radius([verts[i] for i in ring])
+    start_direction = (Vector(verts[loop[0]]) - loop_center).normalized()
+    start = max(range(len(ring)), \
+        key=lambda j: (Vector(verts[ring[j]]) - ring_center).normalized().dot(start_direction))
+    return ring[start:] + ring[:start]
+
+def get_joint_geometry(parent_ring, parent_direction, child_rings, split_direction, split_offset):
+    # Crotch vertices and faces joining the last ring of a parent to the first kept
+    # rings of its two children, given as positions. The faces index the parent ring,
+    # then the two child rings, then the crotch vertices. The parent ring is split in
+    # two arcs by the plane separating the children, and each arc is closed by a row
+    # of crotch vertices on the plane, shared by both sides: each side stays on its
+    # own side of the plane.
+    verts = [Vector(vert) for ring in [parent_ring] + child_rings for vert in ring]
+    resolution = len(parent_ring)
+    ring_positions = verts[:resolution]
+    parent_center, _ = get_ring_center_radius(ring_positions)
+    side_direction = parent_direction.cross(split_direction)
+    child_loops = []
+    first_index = resolution
+    for ring in child_rings:
+        child_loops.append(list(range(first_index, first_index + len(ring))))
+        first_index += len(ring)
+
+    # The arcs go between the vertices closest to the plane on either side.
+    side_distances = [(position - parent_center).dot(side_direction) for position in ring_positions]
+    plane_distances = [abs((position - parent_center).dot(split_direction) - split_offset) for position in ring_positions]
+    first_split = min((j for j in range(resolution) if side_distances[j] > 0), key=lambda j: plane_distances[j])
+    second_split = min((j for j in range(resolution) if side_distances[j] <= 0), key=lambda j: plane_distances[j])
+    first_arc = [(first_split + j) % resolution for j in range((second_split - first_split) % resolution + 1)]
+    second_arc = [(second_split + j) % resolution for j in range((first_split - second_split) % resolution + 1)]
+
+    # Crotch vertices, from the second split vertex to the first one, lifted towards
+    # the children in the middle, and kept below the lowest vertex of the children
+    # rings so that the faces don't fold back.
+    crotch_count = max(1, resolution // 2 - 1)
+    lift = max(0, min((vert - parent_center).dot(parent_direction) for vert in verts[resolution:])) / 2
+    crotch_positions = []
+    for i in range(1, crotch_count + 1):
+        factor = i / (crotch_count + 1)
+        crotch_positions.append(ring_positions[second_split].lerp(ring_positions[first_split], factor) + \
+            parent_direction * lift * math.sin(math.pi * factor))
+    crotch = list(range(len(verts), len(verts) + crotch_count))
+    verts.extend(crotch_positions)
+    first_loop = first_arc + crotch
+    second_loop = second_arc + crotch[::-1]
+
+    # The first arc goes to the child on its side.
+    first_arc_side = get_ring_center_radius([verts[i] for i in first_arc])[0] - parent_center
+    if first_arc_side.dot(split_direction) < 0:
+        first_loop, second_loop = second_loop, first_loop
+
+    faces = []
+    for loop, ring in zip([first_loop, second_loop], child_loops):
+        faces.extend(get_bridge_faces(loop, align_ring(verts, loop, ring)))
+    return crotch_positions, faces
+
+def is_joint_intersecting(parent_rings, child_rings, crotch_positions, joint_faces):
+    # Whether the joint faces intersect each other, or the tubes around them: the
+    # last segment of the parent and the first ones of the children, from the rings
+    # joined, with their caps if they end there. The winding of the faces doesn't
+    # matter here.
+    verts = list(parent_rings[-1])
+    faces = list(joint_faces)
+    child_loops = []
+    for rings in child_rings:
+        child_loops.append(list(range(len(verts), len(verts) + len(rings[0]))))
+        verts.extend(rings[0])
+    verts.extend(crotch_positions)
+
+    def add_ring(loop, ring):
+        next_loop = list(range(len(verts), len(verts) + len(ring)))
+        verts.extend(ring)
+        faces.extend(get_bridge_faces(loop, next_loop))
+        return next_loop
+
+    add_ring(list(range(len(parent_rings[-1]))), parent_rings[-2])
+    for loop, rings in zip(child_loops, child_rings):
+        for ring in rings[1:JOINT_CHECK_RINGS + 1]:
+            loop = add_ring(loop, ring)
+        if len(rings) <= JOINT_CHECK_RINGS + 1:
+            faces.append(tuple(loop))
+    tree = BVHTree.FromPolygons(verts, faces)
+    return len(tree.overlap(tree)) > 0
+
+def add_connected_geometry(builder, sections, tree_rings, lod=0):
+    # Adding the tree to the builder as a single surface: at each split the parent
+    # tube continues into its children without caps, and the rings of the children
+    # overlapping each other are replaced by the joint faces. Splits whose children
+    # don't come apart, or whose joint would still intersect the tubes around it,
+    # stay separate closed tubes, and so do the sections without a parent, like the
+    # roots. This is a generator doing a joint or a section per step, so that the
+    # work can be spread in time.
+    if lod > 0:
+        tree_rings = [subsample_rings(rings, lod) if len(rings) >= 2 else rings for rings in tree_rings]
+    children = {}
+    for section_id, section in enumerate(sections):
+        if section.parent_id is not None and len(tree_rings[section_id]) >= 2:
+            children.setdefault(section.parent_id, []).append(section_id)
+
+    joints = {}
+    first_rings = [0] * len(sections)
+    for parent_id, child_ids in children.items():
+        parent_rings = tree_rings[parent_id]
+        if len(child_ids) != 2 or len(parent_rings) < 2:
+            continue
+        parent_points = sections[parent_id].points
+        parent_direction = (parent_points[-1] - parent_points[-2]).normalized()
+        parent_center, _ = get_ring_center_radius(parent_rings[-1])
+        child_rings = [tree_rings[child_id] for child_id in child_ids]
+        split = get_joint_split(parent_center, parent_direction, child_rings)
+        if split is not None:
+            start_rings, split_direction, split_offset = split
+            child_rings = [rings[start_ring:] for rings, start_ring in zip(child_rings, start_rings)]
+            crotch_positions, faces = get_joint_geometry(parent_rings[-1], parent_direction, \
+                [rings[0] for rings in child_rings], split_direction, split_offset)
+            if not is_joint_intersecting(parent_rings, child_rings, crotch_positions, faces):
+                joints[parent_id] = (child_ids, crotch_positions, faces)
+                for child_id, start_ring in zip(child_ids, start_rings):
+                    first_rings[child_id] = start_ring
+        yield
 
-        previous_circle_verts = current_circle_verts
-        bottom_bm_verts = bm_verts.copy()
-        bottom_bm_edges = bm_edges.copy()
+    ring_indices = [None] * len(sections)
+    for section_id, rings in enumerate(tree_rings):
+        if len(rings) < 2:
+            continue
+        rings = rings[first_rings[section_id]:]
+        resolution = len(rings[0])
+        first_index = builder.add_verts(vert for ring in rings for vert in ring)
+        ring_indices[section_id] = [list(range(first_index + i * resolution, first_index + (i + 1) * resolution)) \
+            for i in range(len(rings))]
+        builder.add_faces(get_tube_faces(len(rings), resolution, first_index=first_index, closed=False))
 
-    bm.normal_update()
-    bm.to_mesh(mesh)
-    bm.free()
+        # Capping only the ends that aren't joined to other sections.
+        if sections[section_id].parent_id not in joints:
+            builder.add_faces([tuple(ring_indices[section_id][0])])
+        if section_id not in joints:
+            builder.add_faces([tuple(reversed(ring_indices[section_id][-1]))])
+        yield
 
-    return mesh
\ No newline at end of file
+    # The joint vertices are the parent ring, the child rings and the crotch ones.
+    for parent_id, (child_ids, crotch_positions, faces) in joints.items():
+        first_crotch = builder.add_verts(crotch_positions)
+        vert_indices = ring_indices[parent_id][-1] + \
+            [i for child_id in child_ids for i in ring_indices[child_id][0]] + \
+            list(range(first_crotch, first_crotch + len(crotch_positions)))
+        builder.add_faces([tuple(vert_indices[i] for i in face) for face in faces])
+        yield